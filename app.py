@@ -3,13 +3,15 @@ import os
 import pandas as pd
 import tempfile
 import base64
-import json
+import orjson
 import toml
 from datetime import datetime, timedelta
 import time
-from io import BytesIO
 import zipfile
 import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Import components directly from files
 import gmail_component
@@ -142,7 +144,8 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Load config from secrets.toml
+# Load config from secrets.toml, once per process rather than on every rerun
+@st.cache_resource
 def load_config():
     # Use Streamlit secrets if available
     if hasattr(st, 'secrets'):
@@ -162,95 +165,376 @@ def load_config():
     }
 
 # Database functions for persistent storage
+DB_FILE = 'echeque_processing.db'
+
+@st.cache_resource
+def get_conn():
+    """Shared connection to the processing database, reused across reruns and sessions"""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    """Lock serializing writes on the shared connection"""
+    return threading.Lock()
+
+# Binary fields stored in their own BLOB columns rather than inside the metadata JSON
+BLOB_FIELDS = ['pdf_data', 'original_pdf', 'content']
+
+# Rows replace an earlier row stored under the same filename, but a PDF already stored
+# under another filename is skipped so the first copy wins; letting INSERT OR REPLACE
+# resolve the hash conflict would delete that earlier row while session state refers to it
+INSERT_SQL = (
+    "INSERT OR REPLACE INTO processed_files "
+    "(filename, processed_date, metadata, pdf_data, original_pdf, content, content_sha256) "
+    "SELECT ?, ?, ?, ?, ?, ?, ? "
+    "WHERE NOT EXISTS (SELECT 1 FROM processed_files WHERE content_sha256 = ? AND filename <> ?)"
+)
+
+# Bound parameters per lookup, well under SQLite's limit
+HASH_LOOKUP_CHUNK = 500
+
+def _content_hash(pdf_data):
+    return hashlib.sha256(pdf_data).hexdigest() if pdf_data else None
+
+def _insert_rows(conn, rows):
+    """Insert processed-file rows inside the caller's transaction.
+    
+    Returns:
+        Dict of filename to the stored filename it duplicates, for rows skipped by INSERT_SQL
+    """
+    conn.executemany(INSERT_SQL, [(*row, row[-1], row[0]) for row in rows])
+    
+    # Every hash in the batch now belongs to exactly one stored row; rows not owning theirs were skipped
+    hashes = list({row[-1] for row in rows if row[-1]})
+    owners = {}
+    for start in range(0, len(hashes), HASH_LOOKUP_CHUNK):
+        chunk = hashes[start:start + HASH_LOOKUP_CHUNK]
+        owners.update(conn.execute(
+            f"SELECT content_sha256, filename FROM processed_files "
+            f"WHERE content_sha256 IN ({', '.join('?' * len(chunk))})", chunk
+        ))
+    return {row[0]: owners[row[-1]] for row in rows if row[-1] and owners[row[-1]] != row[0]}
+
+@st.cache_resource
 def init_db():
-    conn = sqlite3.connect('echeque_processing.db', isolation_level=None)
+    """Create or migrate the schema; cached so it runs once per process, not on every rerun"""
+    conn = get_conn()
+    
+    # SQLite DDL is transactional, so the rename, create, copy and drop of a migration
+    # either all happen or none do
+    with get_db_lock():
+        conn.execute("BEGIN")
+        try:
+            _create_schema(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    return conn
+
+def _create_schema(conn):
+    """Bring the schema up to date, migrating legacy rows; runs inside init_db's transaction"""
     c = conn.cursor()
+    
+    # Databases created before the BLOB columns existed keep everything in a single JSON column
+    c.execute("PRAGMA table_info(processed_files)")
+    if 'data' in {row[1] for row in c.fetchall()}:
+        c.execute("ALTER TABLE processed_files RENAME TO processed_files_legacy")
+    
     # Create tables if they don't exist
     c.execute('''
     CREATE TABLE IF NOT EXISTS processed_files (
         filename TEXT PRIMARY KEY,
         processed_date TEXT,
-        data TEXT
+        metadata TEXT,
+        pdf_data BLOB,
+        original_pdf BLOB,
+        content BLOB,
+        content_sha256 TEXT
     )
     ''')
-    conn.close()
+    
+    # Add the hash column to tables created before it existed
+    c.execute("PRAGMA table_info(processed_files)")
+    missing_hash = 'content_sha256' not in {row[1] for row in c.fetchall()}
+    if missing_hash:
+        c.execute("ALTER TABLE processed_files ADD COLUMN content_sha256 TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_processed_files_sha256 ON processed_files (content_sha256)")
+    
+    # Backfill hashes; rows duplicating an earlier PDF keep a NULL hash
+    if missing_hash:
+        rows = c.execute("SELECT filename, pdf_data FROM processed_files").fetchall()
+        c.executemany(
+            "UPDATE OR IGNORE processed_files SET content_sha256 = ? WHERE filename = ?",
+            [(_content_hash(pdf_data), filename) for filename, pdf_data in rows]
+        )
+    
+    # Also picks up a legacy table left behind by an interrupted earlier migration
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'processed_files_legacy'")
+    if c.fetchone():
+        _migrate_legacy_table(conn)
 
-def load_from_db():
-    conn = sqlite3.connect('echeque_processing.db')
-    c = conn.cursor()
+def _decode_legacy_row(data_json):
+    """Decode a row stored in the legacy single-column format"""
+    file_data = orjson.loads(data_json)
     
-    # Load processed filenames
-    c.execute("SELECT filename FROM processed_files")
-    filenames = {row[0] for row in c.fetchall()}
+    # Convert base64 fields back to bytes
+    binary_fields = ['content', 'pdf', 'original_pdf', 'pdf_data']
+    for field in binary_fields:
+        field_base64_key = f'_{field}_is_base64'
+        if field_base64_key in file_data and file_data[field_base64_key]:
+            if field in file_data:  # Check if the field exists
+                file_data[field] = base64.b64decode(file_data[field])
+            del file_data[field_base64_key]
+    
+    return file_data
+
+def _convert_legacy_row(legacy_row):
+    processed_date, data_json = legacy_row
+    filename, *values = _serialize(_decode_legacy_row(data_json))
+    return (filename, processed_date, *values)
+
+def _migrate_legacy_table(conn):
+    """Move rows from the legacy table into the BLOB column layout, within the caller's transaction"""
+    legacy_rows = conn.execute("SELECT processed_date, data FROM processed_files_legacy").fetchall()
+    # base64 decoding and hashing release the GIL, so spread the rows across threads
+    with ThreadPoolExecutor() as executor:
+        rows = list(executor.map(_convert_legacy_row, legacy_rows))
+    _insert_rows(conn, rows)
+    conn.execute("DROP TABLE processed_files_legacy")
+
+def load_index():
+    """Load processed filenames and file metadata; binary fields are fetched later with load_blob"""
+    c = get_conn().cursor()
     
-    # Load processed files data
-    c.execute("SELECT data FROM processed_files")
+    # Load processed filenames and metadata in one pass, leaving the PDF bytes in the database
+    c.execute("SELECT filename, metadata, length(pdf_data) FROM processed_files")
+    filenames = set()
     files_data = []
-    for row in c.fetchall():
-        file_data = json.loads(row[0])
-        
-        # Convert base64 fields back to bytes
-        binary_fields = ['content', 'pdf', 'original_pdf', 'pdf_data']
-        for field in binary_fields:
-            field_base64_key = f'_{field}_is_base64'
-            if field_base64_key in file_data and file_data[field_base64_key]:
-                if field in file_data:  # Check if the field exists
-                    file_data[field] = base64.b64decode(file_data[field])
-                del file_data[field_base64_key]
-            
+    for filename, metadata, pdf_size in c:
+        filenames.add(filename)
+        file_data = orjson.loads(metadata)
+        file_data['pdf_size'] = pdf_size or 0
         files_data.append(file_data)
     
-    conn.close()
     return filenames, files_data
 
-def save_to_db(processed_file):
-    conn = sqlite3.connect('echeque_processing.db')
-    c = conn.cursor()
-    
-    filename = processed_file.get('original_filename') or processed_file.get('generated_filename')
-    processed_date = datetime.now().isoformat()
+def load_blob(filename, field):
+    """Fetch a single binary field for a processed file"""
+    if field not in BLOB_FIELDS:
+        raise ValueError(f"Not a binary field: {field}")
+    row = get_conn().execute(
+        f"SELECT {field} FROM processed_files WHERE filename = ?", (filename,)
+    ).fetchone()
+    return row[0] if row else None
+
+def db_key(processed_file):
+    """Primary key a processed file is stored under"""
+    return processed_file.get('original_filename') or processed_file.get('generated_filename')
+
+def get_pdf_data(processed_file):
+    """PDF bytes of a processed file, from memory if present, otherwise from the database"""
+    if 'pdf_data' in processed_file:
+        return processed_file['pdf_data']
+    return load_blob(db_key(processed_file), 'pdf_data')
+
+def get_pdf_size(processed_file):
+    """Size in bytes of a processed file's PDF without loading it"""
+    if 'pdf_data' in processed_file:
+        return len(processed_file['pdf_data'])
+    return processed_file.get('pdf_size', 0)
+
+def _serialize(processed_file):
+    """Return the database key, metadata JSON, BLOB column values and PDF hash for a processed file"""
+    filename = db_key(processed_file)
     
     # Create a copy of the processed_file to modify for storage
     storage_file = processed_file.copy()
     
-    # Handle binary content fields
-    binary_fields = ['content', 'pdf', 'original_pdf', 'pdf_data']
-    for field in binary_fields:
-        if field in storage_file and isinstance(storage_file[field], bytes):
-            storage_file[field] = base64.b64encode(storage_file[field]).decode('utf-8')
-            storage_file[f'_{field}_is_base64'] = True
+    # Pull out the fields stored as BLOBs so only small metadata is JSON encoded
+    blobs = [storage_file.pop(field, None) for field in BLOB_FIELDS]
+    storage_file.pop('pdf_size', None)
     
-    # Convert to JSON
+    # Convert to JSON; orjson's error already names the offending type, so there is no
+    # need to re-serialize each key to find it
     try:
-        data_json = json.dumps(storage_file)
+        metadata_json = orjson.dumps(storage_file).decode('utf-8')
     except TypeError as e:
-        # If any other binary fields are found, print more debug info
-        problematic_keys = []
-        for key, value in storage_file.items():
-            try:
-                json.dumps({key: value})
-            except TypeError:
-                problematic_keys.append(f"{key} (type: {type(value)})")
-        
-        # Raise a more informative error
-        raise TypeError(f"Cannot JSON serialize these keys: {', '.join(problematic_keys)}") from e
+        raise TypeError(f"Cannot JSON serialize processed file {filename}: {e}") from e
     
-    c.execute(
-        "INSERT OR REPLACE INTO processed_files (filename, processed_date, data) VALUES (?, ?, ?)",
-        (filename, processed_date, data_json)
-    )
+    return filename, metadata_json, *blobs, _content_hash(processed_file.get('pdf_data'))
+
+def save_many_to_db(processed_files):
+    """Save a batch of processed files in a single transaction.
     
-    conn.commit()
-    conn.close()
+    Returns:
+        Dict of database key to the stored key it duplicates, for files that were not saved
+        because the same PDF is already stored under another name
+    """
+    processed_date = datetime.now().isoformat()
+    rows = []
+    for processed_file in processed_files:
+        filename, *values = _serialize(processed_file)
+        rows.append((filename, processed_date, *values))
+    
+    if not rows:
+        return {}
+    
+    conn = get_conn()
+    with get_db_lock():
+        conn.execute("BEGIN")
+        try:
+            duplicates = _insert_rows(conn, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return duplicates
+
+def save_to_db(processed_file):
+    return save_many_to_db([processed_file])
+
+def clear_db():
+    """Delete all processed files and hand the freed pages back to the filesystem"""
+    conn = get_conn()
+    with get_db_lock():
+        conn.execute("DELETE FROM processed_files")
+        conn.execute("PRAGMA optimize")
+        # Stored PDFs leave a large free list behind; VACUUM is cheap once the table is empty
+        conn.execute("VACUUM")
 
 # Function to create zip from files
 def create_zip_from_files(files):
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        for file in files:
-            zip_file.writestr(file['filename'], file['content'])
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+    # PDFs are already compressed, so store them as-is rather than spending CPU on DEFLATE.
+    # The archive spills to disk past 64 MB instead of being held twice in memory.
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as zip_buffer:
+        with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+            for file in files:
+                if 'content' in file:
+                    zip_file.writestr(file['filename'], file['content'])
+                else:
+                    # Gmail attachments are only kept on disk
+                    zip_file.write(file['path'], file['filename'])
+        zip_buffer.seek(0)
+        return zip_buffer.read()
+
+@st.cache_data(max_entries=4)
+def build_zip(keys, _files):
+    """Zip processed files, cached on their (filename, size) keys so reruns reuse the archive"""
+    entries = [
+        {'filename': file['generated_filename'], 'content': get_pdf_data(file)}
+        for file in _files
+    ]
+    # A file whose PDF is no longer stored is left out rather than failing the whole archive
+    return create_zip_from_files([entry for entry in entries if entry['content'] is not None])
+
+def _wrap_uploaded(uploaded_file):
+    """Convert a Streamlit upload into the file dict used by the pipeline"""
+    file_content = uploaded_file.getvalue()
+    return {
+        'filename': uploaded_file.name,
+        'content': file_content,
+        'email_subject': 'Manual Upload',
+        'email_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'size': len(file_content)
+    }
+
+def add_processed_files(processed_files):
+    """Merge newly processed files into session state, keeping processed_filenames in step"""
+    # Results are keyed like the database so a reprocessed file replaces its earlier
+    # result; matching on the key avoids comparing whole dicts (PDF bytes included)
+    positions = {db_key(file): i for i, file in enumerate(st.session_state.processed_files)}
+    for file in processed_files:
+        key = db_key(file)
+        if key in positions:
+            st.session_state.processed_files[positions[key]] = file
+        else:
+            positions[key] = len(st.session_state.processed_files)
+            st.session_state.processed_files.append(file)
+        st.session_state.processed_filenames.add(key)
+
+def upload_result_rows(upload_results):
+    """Reduce Teams upload results to the hashable rows shown in the results table"""
+    return tuple(
+        (result['filename'],
+         "✅ Success" if result['success'] else "❌ Failed",
+         result.get('target_folder', 'Unknown'),
+         result.get('error', '') if not result['success'] else '')
+        for result in upload_results
+    )
+
+@st.cache_data(max_entries=4)
+def build_upload_results_df(rows):
+    """Tabulate upload result rows column by column, cached so reruns skip the rebuild"""
+    filenames, statuses, folders, errors = zip(*rows) if rows else ((), (), (), ())
+    return pd.DataFrame({
+        "Filename": list(filenames),
+        "Status": list(statuses),
+        "Target Folder": list(folders),
+        "Error": list(errors)
+    })
+
+@st.cache_data(max_entries=4)
+def build_upload_report_csv(rows):
+    """CSV upload report for the same rows, cached alongside the table"""
+    return build_upload_results_df(rows).to_csv(index=False)
+
+@st.fragment
+def file_picker(files):
+    """Select files for the Teams upload; interacting reruns only this fragment, not the whole page"""
+    # Initialize select_all state if not exists
+    if 'select_all_files' not in st.session_state:
+        st.session_state.select_all_files = False
+    # Bumping the version gives the editor a fresh key so Select All/Clear override earlier ticks
+    if 'file_picker_version' not in st.session_state:
+        st.session_state.file_picker_version = 0
+    
+    # Add select all/none buttons in a row
+    col1, col2, col3 = st.columns([1, 1, 5])
+    with col1:
+        if st.button("Select All"):
+            st.session_state.select_all_files = True
+            st.session_state.file_picker_version += 1
+    with col2:
+        if st.button("Clear Selection"):
+            st.session_state.select_all_files = False
+            st.session_state.file_picker_version += 1
+    with col3:
+        # Add reset button to clear upload results
+        if 'upload_results' in st.session_state and st.button("Reset Upload Status"):
+            if 'upload_results' in st.session_state:
+                del st.session_state.upload_results
+            st.rerun()
+    
+    # One editable table instead of a checkbox widget per file
+    picker_df = pd.DataFrame({
+        "Upload": [st.session_state.select_all_files] * len(files),
+        "Filename": [file['generated_filename'] for file in files]
+    })
+    edited_df = st.data_editor(
+        picker_df,
+        key=f"file_picker_{st.session_state.file_picker_version}",
+        column_config={"Upload": st.column_config.CheckboxColumn("Upload")},
+        disabled=["Filename"],
+        hide_index=True,
+        use_container_width=True
+    )
+    
+    # The upload button lives outside the fragment, so hand the selection over via session state
+    st.session_state.selected_upload_keys = {db_key(files[i]) for i in edited_df.index[edited_df["Upload"]]}
+    
+    # Display selected count
+    if st.session_state.selected_upload_keys:
+        st.markdown(f"**{len(st.session_state.selected_upload_keys)} files selected for upload**")
+    else:
+        st.warning("Please select at least one file to upload")
 
 # Load configuration
 config = load_config()
@@ -263,9 +547,10 @@ if 'downloaded_files' not in st.session_state:
     st.session_state.downloaded_files = []
 if 'processed_files' not in st.session_state:
     st.session_state.processed_files = []
-# Load processed filenames from database
+# Load processed filenames from database. processed_filenames is the membership index for
+# processed_files: every stored file's key is in it, so lookups never scan the list of dicts
 if 'processed_filenames' not in st.session_state:
-    filenames, files_data = load_from_db()
+    filenames, files_data = load_index()
     st.session_state.processed_filenames = filenames
     st.session_state.processed_files = files_data
 
@@ -374,19 +659,21 @@ with tabs[0]:
                     ✅ Successfully downloaded {len(downloaded_files)} e-Cheques!
                     </div>
                     """, unsafe_allow_html=True)
+                    if error:
+                        st.warning(error)
                     
                     # Display downloaded files
                     st.markdown('<div class="subheader">Downloaded e-Cheques</div>', unsafe_allow_html=True)
-                    file_data = []
-                    for file in downloaded_files:
-                        file_data.append({
+                    file_df = pd.DataFrame.from_records(
+                        ({
                             "Filename": file.get('filename', 'Unknown'),
                             "Email Subject": file.get('email_subject', 'Unknown'),
                             "Email Date": file.get('email_date', 'Unknown'),
-                            "Size": f"{len(file.get('content', b'')) / 1024:.1f} KB"
-                        })
-                    
-                    file_df = pd.DataFrame(file_data)
+                            "Size_KB": file.get('size', 0) / 1024
+                        } for file in downloaded_files),
+                        columns=["Filename", "Email Subject", "Email Date", "Size_KB"]
+                    )
+                    file_df["Size"] = file_df.pop("Size_KB").map('{:.1f} KB'.format)
                     st.dataframe(file_df, use_container_width=True)
                     
                     # Store attachments in session state
@@ -428,16 +715,8 @@ with tabs[0]:
     
     if uploaded_files:
         if st.button("📤 Add Uploaded Files"):
-            new_files = []
-            for uploaded_file in uploaded_files:
-                file_content = uploaded_file.read()
-                new_files.append({
-                    'filename': uploaded_file.name,
-                    'content': file_content,
-                    'email_subject': 'Manual Upload',
-                    'email_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'size': len(file_content)
-                })
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                new_files = list(executor.map(_wrap_uploaded, uploaded_files))
             
             # Add to existing files
             st.session_state.downloaded_files.extend(new_files)
@@ -452,16 +731,19 @@ with tabs[0]:
     if st.session_state.downloaded_files and not submit_button:
         st.markdown('<div class="subheader">Files Ready for Processing</div>', unsafe_allow_html=True)
         
-        file_data = []
-        for file in st.session_state.downloaded_files:
-            file_data.append({
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        file_df = pd.DataFrame.from_records(
+            ({
                 "Filename": file.get('filename', 'Unknown'),
                 "Source": file.get('email_subject', 'Manual Upload'),
-                "Date": file.get('email_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
-                "Size": f"{len(file.get('content', b'')) / 1024:.1f} KB"
-            })
+                "Date": file.get('email_date', now_str),
+                "Size_KB": file.get('size', 0) / 1024
+            } for file in st.session_state.downloaded_files),
+            columns=["Filename", "Source", "Date", "Size_KB"]
+        )
+        file_df["Size"] = file_df.pop("Size_KB").map('{:.1f} KB'.format)
         
-        st.dataframe(file_data, use_container_width=True)
+        st.dataframe(file_df, use_container_width=True)
         
         col1, col2 = st.columns([1, 4])
         with col1:
@@ -526,16 +808,14 @@ with tabs[1]:
                 st.markdown("---")
                 st.markdown('<div class="subheader">Download Previously Processed Files</div>', unsafe_allow_html=True)
                 
-                zip_files = []
-                for processed_file in st.session_state.processed_files:
-                    zip_files.append({
-                        'filename': processed_file['generated_filename'],
-                        'content': processed_file['pdf_data']
-                    })
+                zip_keys = tuple(
+                    (processed_file['generated_filename'], get_pdf_size(processed_file))
+                    for processed_file in st.session_state.processed_files
+                )
                 
                 st.download_button(
                     label="📥 Download All Processed Files as ZIP",
-                    data=create_zip_from_files(zip_files),
+                    data=build_zip(zip_keys, st.session_state.processed_files),
                     file_name=f"all_processed_echeques_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
                     mime="application/zip"
                 )
@@ -543,6 +823,15 @@ with tabs[1]:
         # Get Gemini API key from config but don't display an input field
         gemini_api_key = config.get('gemini', {}).get('api_key', '')
         
+        # Gemini calls per second allowed by the project's quota tier
+        try:
+            gemini_rate = float(config.get('gemini', {}).get('requests_per_second',
+                                                             processing_component.MAX_REQUESTS_PER_SECOND))
+        except (TypeError, ValueError):
+            gemini_rate = 0
+        if gemini_rate <= 0:
+            gemini_rate = processing_component.MAX_REQUESTS_PER_SECOND
+        
         # Process button
         if st.button("🔍 Process e-Cheques"):
             if not gemini_api_key:
@@ -566,17 +855,21 @@ with tabs[1]:
                         processed_files, errors = processing_component.process_echeques(
                             files_to_process, 
                             gemini_api_key, 
-                            progress_callback=progress_callback
+                            progress_callback=progress_callback,
+                            requests_per_second=gemini_rate
                         )
                         
-                        # Store processed results in session state
-                        for file in processed_files:
-                            if file not in st.session_state.processed_files:
-                                st.session_state.processed_files.append(file)
+                        # Save all processed files to the database in one transaction
+                        duplicates = save_many_to_db(processed_files)
                         
-                        # Save each processed file to the database
-                        for processed_file in processed_files:
-                            save_to_db(processed_file)
+                        # Files the database skipped as duplicates stay out of session state too
+                        if duplicates:
+                            processed_files = [file for file in processed_files if db_key(file) not in duplicates]
+                            st.warning("Skipped e-cheques already stored under another name: " + "; ".join(
+                                f"{key} duplicates {stored_key}" for key, stored_key in duplicates.items()))
+                        
+                        # Store processed results in session state
+                        add_processed_files(processed_files)
                         
                         # Update set of processed filenames
                         for file in files_to_process:
@@ -668,25 +961,17 @@ with tabs[2]:
     col1, col2 = st.columns([1, 4])
     with col1:
         if st.button("🗑️ Clear All Files", type="primary"):
-            # Clear session state
-            if 'downloaded_files' in st.session_state:
-                st.session_state.downloaded_files = []
-            if 'processed_files' in st.session_state:
-                st.session_state.processed_files = []
-            if 'processed_filenames' in st.session_state:
-                st.session_state.processed_filenames = set()
-            if 'upload_results' in st.session_state:
-                del st.session_state.upload_results
-            if 'select_all_files' in st.session_state:
-                st.session_state.select_all_files = False
+            # Clear session state; the file lists are always initialized at the top of the script
+            st.session_state.downloaded_files = []
+            st.session_state.processed_files = []
+            st.session_state.processed_filenames = set()
+            st.session_state.pop('upload_results', None)
+            st.session_state.select_all_files = False
             
-            # Clear database
+            # Clear database and drop cached archives still holding the PDF bytes
             try:
-                conn = sqlite3.connect('echeque_processing.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM processed_files")
-                conn.commit()
-                conn.close()
+                clear_db()
+                build_zip.clear()
                 st.success("Successfully cleared all files!")
                 time.sleep(1)  # Brief pause to show success message
                 st.rerun()  # Refresh the page
@@ -709,40 +994,12 @@ with tabs[2]:
         # Show file count
         st.markdown(f"**{len(st.session_state.processed_files)} files available for upload:**")
         
-        # Initialize select_all state if not exists
-        if 'select_all_files' not in st.session_state:
-            st.session_state.select_all_files = False
-        
-        # Add select all/none buttons in a row
-        col1, col2, col3 = st.columns([1, 1, 5])
-        with col1:
-            if st.button("Select All"):
-                st.session_state.select_all_files = True
-                st.rerun()
-        with col2:
-            if st.button("Clear Selection"):
-                st.session_state.select_all_files = False
-                st.rerun()
-        with col3:
-            # Add reset button to clear upload results
-            if 'upload_results' in st.session_state and st.button("Reset Upload Status"):
-                if 'upload_results' in st.session_state:
-                    del st.session_state.upload_results
-                st.rerun()
-        
-        # Let user select which PDFs to upload        
-        selected_files = []
-        with st.container():
-            # File selection with checkboxes - use select_all state
-            for i, file in enumerate(st.session_state.processed_files):
-                if st.checkbox(f"{file['generated_filename']}", value=st.session_state.select_all_files, key=f"pdf_{i}"):
-                    selected_files.append(file)
-        
-        # Display selected count
-        if selected_files:
-            st.markdown(f"**{len(selected_files)} files selected for upload**")
-        else:
-            st.warning("Please select at least one file to upload")
+        # Let user select which PDFs to upload
+        file_picker(st.session_state.processed_files)
+        selected_files = [
+            file for file in st.session_state.processed_files
+            if db_key(file) in st.session_state.selected_upload_keys
+        ]
         
         # Upload button - show batch status for multiple files
         if st.button("📤 Upload to Teams"):
@@ -769,9 +1026,23 @@ with tabs[2]:
                         if len(selected_files) > 1:
                             progress_placeholder.info(f"Preparing to upload {len(selected_files)} files in batch...")
                             
+                        # Fetch PDF bytes only for the files being uploaded
+                        files_to_upload = []
+                        missing_files = []
+                        for file in selected_files:
+                            pdf_data = get_pdf_data(file)
+                            if pdf_data is None:
+                                missing_files.append(file['generated_filename'])
+                            else:
+                                files_to_upload.append({**file, 'pdf_data': pdf_data})
+                        
+                        if missing_files:
+                            st.warning(f"Skipping {len(missing_files)} file(s) whose PDF is no longer stored: "
+                                       f"{', '.join(missing_files)}")
+                        
                         # Upload files
                         upload_results, error, _, _ = teams_component.upload_files_to_teams(
-                            selected_files,
+                            files_to_upload,
                             teams_creds.get('client_id', ''),
                             teams_creds.get('client_secret', ''),
                             teams_creds.get('tenant_id', ''),
@@ -800,16 +1071,8 @@ with tabs[2]:
                             # Display results
                             st.markdown('<div class="subheader">Upload Results</div>', unsafe_allow_html=True)
                             
-                            results_data = []
-                            for result in upload_results:
-                                results_data.append({
-                                    "Filename": result['filename'],
-                                    "Status": "✅ Success" if result['success'] else "❌ Failed",
-                                    "Target Folder": result.get('target_folder', 'Unknown'),
-                                    "Error": result.get('error', '') if not result['success'] else ''
-                                })
-                            
-                            results_df = pd.DataFrame(results_data)
+                            result_rows = upload_result_rows(upload_results)
+                            results_df = build_upload_results_df(result_rows)
                             st.dataframe(results_df, use_container_width=True)
                             
                             # Show confirmation message and next steps
@@ -821,7 +1084,7 @@ with tabs[2]:
                                 """, unsafe_allow_html=True)
                                 
                                 # Add download button for upload report
-                                csv_data = results_df.to_csv(index=False)
+                                csv_data = build_upload_report_csv(result_rows)
                                 st.download_button(
                                     label="📊 Download Upload Report as CSV",
                                     data=csv_data,
@@ -837,16 +1100,7 @@ with tabs[2]:
             st.markdown("---")
             st.markdown('<div class="subheader">Previous Upload Results</div>', unsafe_allow_html=True)
             
-            results_data = []
-            for result in st.session_state.upload_results:
-                results_data.append({
-                    "Filename": result['filename'],
-                    "Status": "✅ Success" if result['success'] else "❌ Failed",
-                    "Target Folder": result.get('target_folder', 'Unknown'),
-                    "Error": result.get('error', '') if not result['success'] else ''
-                })
-            
-            results_df = pd.DataFrame(results_data)
+            results_df = build_upload_results_df(upload_result_rows(st.session_state.upload_results))
             st.dataframe(results_df, use_container_width=True)
                         
 # Footer with helpful information
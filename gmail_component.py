@@ -4,11 +4,30 @@ from googleapiclient.discovery import build
 import base64
 import os
 import tempfile
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 # Gmail API scopes - we only need readonly for searching and downloading
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Number of emails fetched at once, kept modest to stay within Gmail's per-user quota
+MAX_CONCURRENT_FETCHES = 10
+
+# Largest page Gmail returns from messages.list
+LIST_PAGE_SIZE = 500
+
+# Sub-requests per Gmail batch call; the API allows 100 but throttles batches above 50
+GMAIL_BATCH_SIZE = 50
+
+# Retries of batch lookups that hit rate limits or server errors
+BATCH_MAX_RETRIES = 5
+BATCH_INITIAL_WAIT = 1  # seconds
+BATCH_MAX_WAIT = 32  # seconds
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
 def get_gmail_service(gmail_secrets):
     """Initialize Gmail service with token-based authentication from secrets"""
     try:
@@ -42,86 +61,155 @@ def search_echeque_emails(service, start_date, end_date):
     query = f'subject:"{subject}" after:{start_date_str} before:{end_date_str}'
     
     try:
-        # Execute search
-        result = service.users().messages().list(userId='me', q=query).execute()
+        # Execute search; only message ids are needed, so trim the response to those
+        list_args = {'userId': 'me', 'q': query, 'maxResults': LIST_PAGE_SIZE,
+                     'fields': 'messages(id),nextPageToken'}
+        result = service.users().messages().list(**list_args).execute()
         messages = result.get('messages', [])
         
         # Get more messages if there are any
         while 'nextPageToken' in result:
             page_token = result['nextPageToken']
-            result = service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
+            result = service.users().messages().list(pageToken=page_token, **list_args).execute()
             messages.extend(result.get('messages', []))
         
         return messages, None
     except Exception as e:
         return None, f"Error searching emails: {str(e)}"
 
+def parse_email_details(msg_id, message):
+    """Extract the fields we use from a full Gmail message resource."""
+    # Extract headers
+    headers = {header['name']: header['value'] for header in message['payload']['headers']}
+    subject = headers.get('Subject', 'No Subject')
+    sender = headers.get('From', 'Unknown')
+    date = headers.get('Date', 'Unknown')
+    
+    return {
+        'id': msg_id,
+        'subject': subject,
+        'sender': sender,
+        'date': date,
+        'message': message
+    }
+
 def get_email_details(service, msg_id):
     """Get details of a specific email."""
     try:
-        message = service.users().messages().get(userId='me', id=msg_id).execute()
-        
-        # Extract headers
-        headers = message['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'] == 'Subject'), 'No Subject')
-        sender = next((header['value'] for header in headers if header['name'] == 'From'), 'Unknown')
-        date = next((header['value'] for header in headers if header['name'] == 'Date'), 'Unknown')
-        
-        return {
-            'id': msg_id,
-            'subject': subject,
-            'sender': sender,
-            'date': date,
-            'message': message
-        }, None
+        message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        return parse_email_details(msg_id, message), None
     except Exception as e:
         return None, f"Error getting email details: {str(e)}"
 
+def is_retryable_error(exception):
+    """Whether a failed Gmail request is worth retrying (rate limits and server errors)"""
+    status = getattr(getattr(exception, 'resp', None), 'status', None)
+    return status in RETRYABLE_STATUSES or 'rateLimitExceeded' in str(exception)
+
+def get_email_details_batch(service, msg_ids):
+    """Get details of many emails, packing up to GMAIL_BATCH_SIZE lookups into each HTTP request.
+    
+    Lookups that fail with a rate limit or server error are batched again with backoff.
+    
+    Returns:
+        (details keyed by message id, ids of messages that still failed, error_message)
+    """
+    details = {}
+    failed = {}
+    
+    def handle_response(request_id, response, exception):
+        if exception is None:
+            details[request_id] = parse_email_details(request_id, response)
+        else:
+            failed[request_id] = exception
+    
+    try:
+        given_up = []
+        pending = list(msg_ids)
+        for attempt in range(BATCH_MAX_RETRIES + 1):
+            failed.clear()
+            for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=handle_response)
+                for msg_id in pending[start:start + GMAIL_BATCH_SIZE]:
+                    # format='full' includes the attachment parts, so no second lookup is needed
+                    batch.add(service.users().messages().get(userId='me', id=msg_id, format='full'),
+                              request_id=msg_id)
+                batch.execute()
+            
+            pending = [msg_id for msg_id, exception in failed.items() if is_retryable_error(exception)]
+            given_up.extend(msg_id for msg_id, exception in failed.items() if not is_retryable_error(exception))
+            if not pending or attempt == BATCH_MAX_RETRIES:
+                break
+            # Back-to-back batches can exceed the per-user quota, so wait before re-sending
+            time.sleep(random.uniform(0, min(BATCH_MAX_WAIT, BATCH_INITIAL_WAIT * 2 ** attempt)))
+        
+        return details, given_up + pending, None
+    except Exception as e:
+        return None, None, f"Error getting email details: {str(e)}"
+
+def attachment_parts(message_data):
+    """List the payload parts of a full Gmail message that carry an attachment."""
+    return [part for part in message_data['payload'].get('parts', [])
+            if part.get('filename') and part.get('body', {}).get('attachmentId')]
+
+def download_attachment(service, msg_id, part, download_dir):
+    """Download a single attachment part of an email."""
+    filename = part['filename']
+    
+    # Get attachment
+    attachment = service.users().messages().attachments().get(
+        userId='me', messageId=msg_id, id=part['body']['attachmentId']).execute()
+    
+    # Decode attachment data
+    file_data = base64.urlsafe_b64decode(attachment['data'])
+    
+    # Save attachment under a directory of its own message and part; attachments often
+    # share a name, and parts are downloaded concurrently, so a shared path would let one
+    # write truncate or interleave with another
+    attachment_dir = os.path.join(download_dir, msg_id, part.get('partId') or part['body']['attachmentId'])
+    os.makedirs(attachment_dir, exist_ok=True)
+    filepath = os.path.join(attachment_dir, filename)
+    with open(filepath, 'wb') as f:
+        f.write(file_data)
+    
+    return {
+        'filename': filename,
+        'path': filepath,
+        'size': len(file_data)
+    }
+
 def download_attachments(service, message, download_dir):
     """Download attachments from a specific email."""
     try:
-        attachments = []
-        msg_id = message['id']
-        
-        # Get the full message data if not already included
-        if 'message' in message and isinstance(message['message'], dict):
-            message_data = message['message']
-        else:
-            message_data = service.users().messages().get(userId='me', id=msg_id).execute()
-        
-        # Check if there are any parts
-        if 'parts' not in message_data['payload']:
-            return [], None
-        
-        parts = message_data['payload']['parts']
-        
-        for part in parts:
-            if part.get('filename') and part.get('body') and part['body'].get('attachmentId'):
-                attachment_id = part['body']['attachmentId']
-                filename = part['filename']
-                
-                # Get attachment
-                attachment = service.users().messages().attachments().get(
-                    userId='me', messageId=msg_id, id=attachment_id).execute()
-                
-                # Decode attachment data
-                file_data = base64.urlsafe_b64decode(attachment['data'])
-                
-                # Save attachment
-                filepath = os.path.join(download_dir, filename)
-                with open(filepath, 'wb') as f:
-                    f.write(file_data)
-                
-                attachments.append({
-                    'filename': filename,
-                    'path': filepath,
-                    'size': len(file_data),
-                    'content': file_data  # Store the content for later use
-                })
-        
-        return attachments, None
+        # Email details are always fetched with format='full', so the parts are already here
+        return [download_attachment(service, message['id'], part, download_dir)
+                for part in attachment_parts(message['message'])], None
+    except Exception as e:
+        return None, f"Error downloading attachments: {str(e)}"
+
+def fetch_echeque_attachment(thread_state, gmail_secrets, email_details, part, download_dir):
+    """Download one attachment of an email; runs on a worker thread"""
+    # googleapiclient services are not thread-safe, so each worker builds its own
+    service = getattr(thread_state, 'service', None)
+    if service is None:
+        service, error = get_gmail_service(gmail_secrets)
+        if error:
+            return None, error
+        thread_state.service = service
+    
+    try:
+        attachment = download_attachment(service, email_details['id'], part, download_dir)
     except Exception as e:
         return None, f"Error downloading attachments: {str(e)}"
+    
+    return {
+        'email_subject': email_details['subject'],
+        'email_date': email_details['date'],
+        'email_sender': email_details['sender'],
+        'filename': attachment['filename'],
+        'path': attachment['path'],
+        'size': attachment['size']
+    }, None
 
 def search_and_download_echeques(gmail_secrets, start_date, end_date, progress_callback=None):
     """Main function to search and download e-cheques from Gmail.
@@ -154,34 +242,43 @@ def search_and_download_echeques(gmail_secrets, start_date, end_date, progress_c
     if not messages:
         return [], "No e-cheques found in the date range."
     
-    # Download attachments
-    downloaded_files = []
-    
+    # Get email details in batches
     total_messages = len(messages)
-    for i, msg in enumerate(messages):
-        if progress_callback:
-            progress_callback(f"Processing email {i+1}/{total_messages}...")
-        
-        # Get email details
-        email_details, error = get_email_details(service, msg['id'])
-        if error:
-            continue
-        
-        # Download attachments
-        attachments, error = download_attachments(service, email_details, temp_dir)
-        if error:
-            continue
-        
-        # Add to downloaded files
-        for attachment in attachments:
-            downloaded_files.append({
-                'email_subject': email_details['subject'],
-                'email_date': email_details['date'],
-                'email_sender': email_details['sender'],
-                'filename': attachment['filename'],
-                'path': attachment['path'],
-                'size': attachment['size'],
-                'content': attachment['content']
-            })
+    if progress_callback:
+        progress_callback(f"Getting details for {total_messages} emails...")
+    
+    email_details, failed_ids, error = get_email_details_batch(service, [msg['id'] for msg in messages])
+    if error:
+        return None, error
+    
+    # Download every attachment of every email concurrently, not just one email at a time;
+    # results are slotted back by index to keep the search order
+    tasks = [(email_details[msg['id']], part)
+             for msg in messages if msg['id'] in email_details
+             for part in attachment_parts(email_details[msg['id']]['message'])]
+    results = [None] * len(tasks)
+    thread_state = threading.local()
+    
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES) as executor:
+        futures = {
+            executor.submit(fetch_echeque_attachment, thread_state, gmail_secrets,
+                            details, part, temp_dir): i
+            for i, (details, part) in enumerate(tasks)
+        }
+        # Progress is reported from this thread; the callback may touch UI elements
+        for completed, future in enumerate(as_completed(futures), start=1):
+            if progress_callback:
+                progress_callback(f"Downloaded attachment {completed}/{len(futures)}...")
+            
+            file, error = future.result()
+            if error:
+                continue
+            results[futures[future]] = file
+    
+    downloaded_files = [file for file in results if file]
     
+    # Report emails that could not be fetched so their e-cheques are not silently missing
+    if failed_ids:
+        return downloaded_files, (f"Could not fetch {len(failed_ids)} of {total_messages} emails; "
+                                  f"their e-cheques were not downloaded. Try searching again.")
     return downloaded_files, None
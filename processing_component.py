@@ -1,5 +1,4 @@
-import base64
-import json
+import orjson
 import io
 import fitz  # PyMuPDF
 from PIL import Image
@@ -10,7 +9,10 @@ import pandas as pd
 import csv
 import google.generativeai as genai
 import time
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import random
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Constants
 MAPPING_FILE = "payee_mappings.csv"
@@ -18,33 +20,87 @@ MAPPING_COLUMNS = ['Full Name', 'Short Form']
 MAX_RETRIES = 5
 INITIAL_WAIT = 1  # seconds
 MAX_WAIT = 32  # seconds
+MAX_CONCURRENT_REQUESTS = 8  # Gemini calls in flight at once
+# Gemini calls started per second; 15 RPM suits the free tier, paid tiers can raise it
+# with the gemini.requests_per_second secret
+MAX_REQUESTS_PER_SECOND = 0.25
+MAX_RENDER_WORKERS = 4  # PDFs rasterized at once
+MAX_PENDING_IMAGES = 16  # Rendered images waiting for the API, bounds memory use
+RENDER_ZOOM = 2  # Enough resolution for the model to read the cheque
+JPEG_QUALITY = 85
+IMAGE_MIME_TYPE = "image/jpeg"
+RENDER_MATRIX = fitz.Matrix(RENDER_ZOOM, RENDER_ZOOM)
+
+# Characters replaced by sanitize_filename
+SANITIZE_TABLE = str.maketrans({c: '_' for c in '/*?:"<>|'})
+
+# Filename layout per payer; suffix marks trailer (_T) and management (MF) fees
+FILENAME_TEMPLATES = {
+    "WEALTH MANAGEMENT CUBE LIMITED": "{key_identifier} WMC-{payee}{suffix}.pdf",
+    "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT": "{currency} {key_identifier} {payee}{suffix}.pdf",
+}
+DEFAULT_FILENAME_TEMPLATE = "{payee}_{key_identifier}_{currency}{suffix}.pdf"
+
+# Payees whose management fee cheques get the MF suffix
+MANAGEMENT_FEE_PAYEES = frozenset({'OFS', 'OREANA FINANCIAL SERVICES LIMITED'})
+
+# Rate limiting surfaces as HTTP 429 or as quota wording in the error text
+RATE_LIMIT_PATTERN = re.compile(r'\b(429|rate.?limit|quota|resource(?:.has.been)?.exhausted)\b', re.IGNORECASE)
 
 class APIRateLimitError(Exception):
     pass
 
-def generate_prompt(override_prompt: str = "") -> str:
-    if override_prompt:
-        return override_prompt
+class RateLimiter:
+    """Space out calls shared by several threads to at most `rate` per second"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.last_call_time = 0.0
+        self.lock = threading.Lock()
 
-    prompt = """
-    Extract the following information from this e-cheque and return it as JSON. For the currency field, 
-    please normalize it according to these rules:
-    - '¥' or '￥' or 'RMB' should be normalized to 'CNY'
-    - '$' or 'USD' or 'US$' should be normalized to 'USD'
-    - 'HK$' or 'HKD' should be normalized to 'HKD'
-    - '€' should be normalized to 'EUR'
-    - '£' should be normalized to 'GBP'
+    def set_rate(self, rate):
+        with self.lock:
+            self.interval = 1.0 / rate
 
-    Also, analyze the remarks field to determine if this is:
-    1. A trailer fee payment (includes any mention of trailer, rebate for trailer, etc.)
-    2. A management fee payment (only for OFS/Oreana Financial Services, includes managed services fee, management fee, etc.)
+    def wait(self):
+        # Holding the lock while sleeping queues waiting threads one interval apart
+        with self.lock:
+            now = time.monotonic()
+            delay = self.last_call_time + self.interval - now
+            if delay > 0:
+                time.sleep(delay)
+                now += delay
+            self.last_call_time = now
+
+# Shared by all worker threads so the limits hold across a whole batch
+_rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
+_request_slots = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# The Gemini model is built once per API key and shared by every worker
+_MODEL_CACHE = {}
+_model_lock = threading.Lock()
 
-    Schema:
-    {
-      "type": "object",
-      "properties": {
+def get_gemini_model(api_key):
+    """Configure the SDK and build the Gemini model, reusing it while the key is unchanged"""
+    with _model_lock:
+        model = _MODEL_CACHE.get(api_key)
+        if model is None:
+            # genai.configure swaps the SDK's global client, so models built for another key are stale
+            _MODEL_CACHE.clear()
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel('gemini-2.0-flash', 
+                                          generation_config=genai.GenerationConfig(
+                                              temperature=0.0,
+                                              response_mime_type="application/json",
+                                              response_schema=ECHEQUE_SCHEMA))
+            _MODEL_CACHE[api_key] = model
+        return model
+
+# Response schema enforced by the Gemini API, so the reply is always a bare JSON object
+ECHEQUE_SCHEMA = {
+    "type": "object",
+    "properties": {
         "bank_name": { "type": "string", "description": "The name of the bank issuing the e-cheque." },
-        "date": { "type": "string", "format": "date", "description": "The date the e-cheque was issued (YYYY-MM-DD)." },
+        "date": { "type": "string", "description": "The date the e-cheque was issued (YYYY-MM-DD)." },
         "payee": { "type": "string", "description": "The name of the person or entity to whom the e-cheque is payable." },
         "payer": { "type": "string", "description": "The name of the account the funds are drawn from." },
         "amount_numerical": { "type": "string", "description": "The amount of the e-cheque in numerical form (e.g., 66969.77)." },
@@ -56,27 +112,63 @@ def generate_prompt(override_prompt: str = "") -> str:
         "is_trailer_fee": { "type": "boolean", "description": "True if this is a trailer fee payment based on remarks" },
         "is_management_fee": { "type": "boolean", "description": "True if this is a management fee payment for OFS/Oreana" },
         "next_step": { "type": "string" }
-      },
-      "required": ["date", "payee", "amount_numerical", "key_identifier", "payer", "next_step", "is_trailer_fee", "is_management_fee"]
-    }
+    },
+    "required": ["date", "payee", "amount_numerical", "key_identifier", "payer", "currency", "next_step",
+                 "is_trailer_fee", "is_management_fee"]
+}
+
+def generate_prompt(override_prompt: str = "") -> str:
+    if override_prompt:
+        return override_prompt
+
+    # The field layout is enforced through ECHEQUE_SCHEMA, so the prompt only carries the rules
+    prompt = """
+    Extract the details of this e-cheque. For the currency field, 
+    please normalize it according to these rules:
+    - '¥' or '￥' or 'RMB' should be normalized to 'CNY'
+    - '$' or 'USD' or 'US$' should be normalized to 'USD'
+    - 'HK$' or 'HKD' should be normalized to 'HKD'
+    - '€' should be normalized to 'EUR'
+    - '£' should be normalized to 'GBP'
+
+    Also, analyze the remarks field to determine if this is:
+    1. A trailer fee payment (includes any mention of trailer, rebate for trailer, etc.)
+    2. A management fee payment (only for OFS/Oreana Financial Services, includes managed services fee, management fee, etc.)
 
     Rules for next_step determination:
     1. If the 'remarks' field contains "URGENT", set 'next_step' to 'Flag for Manual Review'
     2. If the 'currency' is not 'HKD', set 'next_step' to 'Flag for Manual Review'
     3. Otherwise, set 'next_step' to 'Process Payment'
-
-    Return only the JSON object with no additional text or formatting.
     """
     return prompt
 
+def _mappings_mtime(file_path):
+    """Modification stamp of the mapping file, 0 when it does not exist"""
+    return os.stat(file_path).st_mtime_ns if os.path.exists(file_path) else 0
+
+@functools.lru_cache(maxsize=4)
+def _load_mappings_cached(file_path, mtime):
+    """Read the mapping file and index it; cached until the file's mtime changes"""
+    if mtime:
+        df = pd.read_csv(file_path)
+    else:
+        df = pd.DataFrame(columns=MAPPING_COLUMNS)
+    return df, build_mapping_lookup(df)
+
 def load_mappings(file_path=MAPPING_FILE):
     """Load payee mappings from CSV file"""
     try:
-        if os.path.exists(file_path):
-            df = pd.read_csv(file_path)
-        else:
-            df = pd.DataFrame(columns=MAPPING_COLUMNS)
-        return df, None
+        df, _ = _load_mappings_cached(file_path, _mappings_mtime(file_path))
+        # Callers may edit the frame, so hand out a copy rather than the cached one
+        return df.copy(), None
+    except Exception as e:
+        return None, f"Error loading mappings: {str(e)}"
+
+def load_mapping_lookup(file_path=MAPPING_FILE):
+    """Load payee mappings already indexed for get_payee_shortform"""
+    try:
+        _, mapping_lookup = _load_mappings_cached(file_path, _mappings_mtime(file_path))
+        return mapping_lookup, None
     except Exception as e:
         return None, f"Error loading mappings: {str(e)}"
 
@@ -88,62 +180,75 @@ def save_mappings(df, file_path=MAPPING_FILE):
     except Exception as e:
         return False, f"Error saving mappings: {str(e)}"
 
-def get_payee_shortform(payee, mappings_df):
+def normalize_payee_name(name):
+    """Upper-case a name and collapse runs of whitespace so mapping lookups are exact matches"""
+    return ' '.join(name.upper().split())
+
+def build_mapping_lookup(mappings_df):
+    """Index payee mappings by normalized full name; the first row wins for duplicate names"""
+    mapping_lookup = {}
+    for full_name, short_form in zip(mappings_df['Full Name'], mappings_df['Short Form']):
+        if isinstance(full_name, str):
+            mapping_lookup.setdefault(normalize_payee_name(full_name), short_form)
+    return mapping_lookup
+
+def get_payee_shortform(payee, mapping_lookup):
     """Get short form of payee name from mappings"""
-    if mappings_df.empty:
+    if not mapping_lookup:
         return payee
-        
-    payee_upper = payee.upper().strip()
-    # Remove extra spaces between words and standardize spaces
-    payee_upper = ' '.join(payee_upper.split())
-    
-    # Do the same standardization for the mapping names
-    mappings_df['Standardized_Name'] = mappings_df['Full Name'].str.upper().str.strip().apply(lambda x: ' '.join(x.split()))
-    
-    match = mappings_df[mappings_df['Standardized_Name'] == payee_upper]
-    if not match.empty:
-        return match.iloc[0]['Short Form']
-    return payee
+    return mapping_lookup.get(normalize_payee_name(payee), payee)
 
-def pdf_to_image(pdf_bytes):
-    """Convert PDF to image"""
+def pdf_to_image(pdf_source):
+    """Convert PDF to image; accepts the PDF bytes or a path to the file"""
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if pdf_document.page_count == 0:
-            return None, "Uploaded PDF is empty."
-
-        page = pdf_document.load_page(0)
-        zoom = 4
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_bytes = pix.tobytes("png")
-        pdf_document.close()
+        if isinstance(pdf_source, (bytes, bytearray)):
+            pdf_document = fitz.open(stream=pdf_source, filetype="pdf")
+        else:
+            # Let MuPDF read from disk rather than loading the file into memory first
+            pdf_document = fitz.open(pdf_source)
+        # The context manager closes the document on every path, including errors
+        with pdf_document:
+            if pdf_document.page_count == 0:
+                return None, "Uploaded PDF is empty."
+
+            page = pdf_document.load_page(0)
+            pix = page.get_pixmap(matrix=RENDER_MATRIX, alpha=False)
+            img_bytes = pix.tobytes("jpg", jpg_quality=JPEG_QUALITY)
+            # Drop the pixmap now instead of holding it until the function returns
+            pix = None
+            page = None
         return img_bytes, None
     except Exception as e:
         return None, f"Error converting PDF to image: {str(e)}"
 
 def is_rate_limit_error(exception):
-    return isinstance(exception, APIRateLimitError) or (
-        isinstance(exception, Exception) and 
-        "429" in str(exception)
+    return (
+        isinstance(exception, APIRateLimitError)
+        or getattr(exception, 'code', None) == 429
+        or RATE_LIMIT_PATTERN.search(str(exception)) is not None
     )
 
-@retry(
-    retry=retry_if_exception_type(APIRateLimitError),
-    wait=wait_exponential(multiplier=INITIAL_WAIT, max=MAX_WAIT),
-    stop=stop_after_attempt(MAX_RETRIES),
-    reraise=True
-)
 def call_gemini_api_with_retry(model, prompt_parts):
-    try:
-        response = model.generate_content(prompt_parts)
-        if not response:
-            raise APIRateLimitError("Empty response from API")
-        return response.text.strip()
-    except Exception as e:
-        if "429" in str(e):
-            raise APIRateLimitError(f"Rate limit exceeded: {str(e)}")
-        raise e
+    """Call the model, retrying rate-limit errors with exponential backoff and full jitter"""
+    last_error = None
+    for attempt in range(MAX_RETRIES):
+        try:
+            with _request_slots:
+                _rate_limiter.wait()
+                response = model.generate_content(prompt_parts)
+            if not response:
+                raise APIRateLimitError("Empty response from API")
+            return response.text.strip()
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            last_error = e
+        
+        # Random waits keep files that hit the quota together from retrying in lockstep
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(random.uniform(0, min(MAX_WAIT, INITIAL_WAIT * 2 ** attempt)))
+    
+    raise APIRateLimitError(f"Rate limit exceeded: {str(last_error)}") from last_error
 
 def call_gemini_api(image_bytes, prompt, api_key):
     """Call Gemini Vision API to analyze e-cheque"""
@@ -151,17 +256,12 @@ def call_gemini_api(image_bytes, prompt, api_key):
         return None, "Missing Gemini API key."
 
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash', 
-                                    generation_config=genai.GenerationConfig(temperature=0.0))
+        model = get_gemini_model(api_key)
 
-        image_parts = [{"mime_type": "image/png", 
-                       "data": base64.b64encode(image_bytes).decode("utf-8")}]
+        # The SDK takes raw bytes and encodes them itself on the way out
+        image_parts = [{"mime_type": IMAGE_MIME_TYPE, "data": image_bytes}]
         prompt_parts = [prompt, image_parts[0]]
         
-        # Add delay between requests
-        time.sleep(1)  # Add 1 second delay between requests
-        
         try:
             response_text = call_gemini_api_with_retry(model, prompt_parts)
             return response_text, None
@@ -177,53 +277,39 @@ def call_gemini_api(image_bytes, prompt, api_key):
 
 def sanitize_filename(filename):
     """Remove invalid characters from filename"""
-    invalid_chars = r'[\/*?:"<>|]'
-    return re.sub(invalid_chars, '_', filename)
+    return filename.translate(SANITIZE_TABLE)
 
 def generate_filename(key_identifier, payer, payee, currency, is_trailer_fee, is_management_fee):
     """Generate appropriate filename based on extracted data"""
-    sanitized_payee = sanitize_filename(payee)
-
-    # Check for trailer fee using AI's judgment
+    # Check for trailer fee, then management fee, using AI's judgment
     if is_trailer_fee:
-        if payer == "WEALTH MANAGEMENT CUBE LIMITED":
-            return f"{key_identifier} WMC-{sanitized_payee}_T.pdf"
-        elif payer == "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT":
-            return f"{currency} {key_identifier} {sanitized_payee}_T.pdf"
-        else:
-            return f"{sanitized_payee}_{key_identifier}_{currency}_T.pdf"
-    
-    # Check for management fee using AI's judgment
-    elif is_management_fee and payee.upper() in ['OFS', 'OREANA FINANCIAL SERVICES LIMITED']:
-        if payer == "WEALTH MANAGEMENT CUBE LIMITED":
-            return f"{key_identifier} WMC-{sanitized_payee} MF.pdf"
-        elif payer == "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT":
-            return f"{currency} {key_identifier} {sanitized_payee} MF.pdf"
-        else:
-            return f"{sanitized_payee}_{key_identifier}_{currency} MF.pdf"
-    
-    # Default naming without special suffixes
+        suffix = "_T"
+    elif is_management_fee and payee.upper() in MANAGEMENT_FEE_PAYEES:
+        suffix = " MF"
     else:
-        if payer == "WEALTH MANAGEMENT CUBE LIMITED":
-            return f"{key_identifier} WMC-{sanitized_payee}.pdf"
-        elif payer == "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT":
-            return f"{currency} {key_identifier} {sanitized_payee}.pdf"
-        else:
-            return f"{sanitized_payee}_{key_identifier}_{currency}.pdf"
+        suffix = ""
 
-def process_echeque(pdf_data, gemini_api_key, mappings_df=None, custom_prompt=""):
+    template = FILENAME_TEMPLATES.get(payer, DEFAULT_FILENAME_TEMPLATE)
+    return template.format(key_identifier=key_identifier, payee=sanitize_filename(payee),
+                           currency=currency, suffix=suffix)
+
+def process_echeque(pdf_data, gemini_api_key, mapping_lookup=None, custom_prompt=""):
     """Process a single e-cheque file"""
     # If no mappings provided, try to load
-    if mappings_df is None:
-        mappings_df, error = load_mappings()
+    if mapping_lookup is None:
+        mapping_lookup, error = load_mapping_lookup()
         if error:
-            mappings_df = pd.DataFrame(columns=MAPPING_COLUMNS)
+            mapping_lookup = {}
     
     # Convert PDF to image
     image_bytes, error = pdf_to_image(pdf_data)
     if error:
         return None, error
     
+    return analyze_echeque_image(image_bytes, pdf_data, gemini_api_key, mapping_lookup, custom_prompt)
+
+def analyze_echeque_image(image_bytes, pdf_data, gemini_api_key, mapping_lookup, custom_prompt=""):
+    """Extract e-cheque data from a rendered page image and build the processed result"""
     # Get prompt
     prompt = generate_prompt(custom_prompt)
     
@@ -234,12 +320,7 @@ def process_echeque(pdf_data, gemini_api_key, mappings_df=None, custom_prompt=""
     
     # Process response
     try:
-        # Clean the response string
-        clean_response = raw_response.strip()
-        if clean_response.startswith("```json"):
-            clean_response = clean_response[7:-3]
-        
-        parsed_json = json.loads(clean_response)
+        parsed_json = orjson.loads(raw_response)
         
         # Check for required fields
         required_fields = ["date", "payee", "key_identifier", "payer", "currency", "is_trailer_fee", "is_management_fee"]
@@ -252,7 +333,7 @@ def process_echeque(pdf_data, gemini_api_key, mappings_df=None, custom_prompt=""
         
         # Only apply mapping if payer is NOT "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT"
         if parsed_json['payer'] != "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT":
-            shortened_payee = get_payee_shortform(original_payee, mappings_df)
+            shortened_payee = get_payee_shortform(original_payee, mapping_lookup)
         else:
             # For client trust account, use the original payee name
             shortened_payee = original_payee
@@ -277,52 +358,109 @@ def process_echeque(pdf_data, gemini_api_key, mappings_df=None, custom_prompt=""
             'next_step': parsed_json.get('next_step', 'Unknown')
         }, None
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         return None, f"Error parsing JSON response: {str(e)}"
     except Exception as e:
         return None, f"Error processing e-cheque: {str(e)}"
 
-def process_echeques(downloaded_files, gemini_api_key, progress_callback=None):
+def pdf_source(file_info):
+    """Bytes for uploaded files, or the on-disk path for attachments saved by the Gmail step"""
+    return file_info['content'] if 'content' in file_info else file_info['path']
+
+def read_pdf(file_info):
+    """PDF bytes of a downloaded file, read from disk if not held in memory"""
+    if 'content' in file_info:
+        return file_info['content']
+    with open(file_info['path'], 'rb') as f:
+        return f.read()
+
+def process_echeques(downloaded_files, gemini_api_key, progress_callback=None,
+                     requests_per_second=MAX_REQUESTS_PER_SECOND):
     """Process multiple e-cheque files"""
-    processed_files = []
     errors = []
+    _rate_limiter.set_rate(requests_per_second)
     
     # Load mappings once for all files
-    mappings_df, error = load_mappings()
+    mapping_lookup, error = load_mapping_lookup()
     if error:
-        mappings_df = pd.DataFrame(columns=MAPPING_COLUMNS)
+        mapping_lookup = {}
     
     total_files = len(downloaded_files)
-    for i, file_info in enumerate(downloaded_files):
-        try:
-            if progress_callback:
-                progress_callback(f"Processing file {i+1}/{total_files}: {file_info['filename']}")
-            
-            # Add delay between files
-            if i > 0:
-                time.sleep(2)  # Add 2 second delay between files
-            
-            # Process each file
-            result, error = process_echeque(file_info['content'], gemini_api_key, mappings_df)
-            
-            if error:
-                errors.append({
-                    'filename': file_info['filename'],
-                    'error': error
-                })
-                continue
-            
-            # Add original file info to result
-            result['original_filename'] = file_info['filename']
-            result['email_subject'] = file_info.get('email_subject', 'Unknown')
-            result['email_date'] = file_info.get('email_date', 'Unknown')
-            
-            processed_files.append(result)
-            
-        except Exception as e:
+    results = [None] * total_files
+    completed = 0
+    
+    def finish(i, result, error):
+        nonlocal completed
+        completed += 1
+        file_info = downloaded_files[i]
+        if progress_callback:
+            progress_callback(f"Processed file {completed}/{total_files}: {file_info['filename']}",
+                              completed / total_files)
+        
+        if error:
             errors.append({
                 'filename': file_info['filename'],
-                'error': f"Unexpected error: {str(e)}"
+                'error': error
             })
-            
+            return
+        
+        # Add original file info to result
+        result['original_filename'] = file_info['filename']
+        result['email_subject'] = file_info.get('email_subject', 'Unknown')
+        result['email_date'] = file_info.get('email_date', 'Unknown')
+        
+        results[i] = result
+    
+    # Rendering is CPU-bound and the API call is network-bound, so run them as two stages:
+    # while one file waits on Gemini the next is already being rasterized. Rendered images
+    # hold a slot until analyzed so a slow API cannot pile up images in memory.
+    pending_images = threading.BoundedSemaphore(MAX_PENDING_IMAGES)
+    
+    def render(source):
+        pending_images.acquire()
+        image_bytes, error = None, None
+        try:
+            image_bytes, error = pdf_to_image(source)
+        finally:
+            if image_bytes is None:
+                pending_images.release()
+        return image_bytes, error
+    
+    def analyze(image_bytes, file_info):
+        try:
+            return analyze_echeque_image(image_bytes, read_pdf(file_info), gemini_api_key, mapping_lookup)
+        finally:
+            pending_images.release()
+    
+    with ThreadPoolExecutor(max_workers=MAX_RENDER_WORKERS) as render_pool, \
+            ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as api_pool:
+        render_futures = {
+            render_pool.submit(render, pdf_source(file_info)): i
+            for i, file_info in enumerate(downloaded_files)
+        }
+        
+        # Hand each image to the API stage as soon as it is rendered
+        api_futures = {}
+        for future in as_completed(render_futures):
+            i = render_futures[future]
+            try:
+                image_bytes, error = future.result()
+            except Exception as e:
+                finish(i, None, f"Unexpected error: {str(e)}")
+                continue
+            if error:
+                finish(i, None, error)
+                continue
+            api_futures[api_pool.submit(analyze, image_bytes, downloaded_files[i])] = i
+        
+        for future in as_completed(api_futures):
+            i = api_futures[future]
+            try:
+                result, error = future.result()
+            except Exception as e:
+                result, error = None, f"Unexpected error: {str(e)}"
+            finish(i, result, error)
+    
+    # Keep results in the order the files were given
+    processed_files = [result for result in results if result is not None]
     return processed_files, errors
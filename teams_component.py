@@ -4,22 +4,116 @@ import time
 import os
 import re
 import urllib.parse
-import json
-import random
-import string
+import orjson
 import base64
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# One keep-alive session for all Graph and SharePoint calls, so connections are reused
+# between requests instead of setting up TCP and TLS for each one
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # Throttling (429/503) is retried by _graph_call; the adapter covers other server errors.
+    # raise_on_status=False hands the last response back so callers report its status
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 504],
+                      raise_on_status=False)
+))
+
+# Retries for throttled Graph calls
+GRAPH_MAX_RETRIES = 5
+GRAPH_BACKOFF_BASE = 1  # seconds
+GRAPH_MAX_BACKOFF = 60  # seconds
+
+# Most sub-requests Graph accepts in one $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Files uploaded at once, kept well under Graph's per-app throttling limits
+MAX_CONCURRENT_UPLOADS = 8
+
+# Endpoints tried in turn by get_teams, asking only for the fields the app shows
+TEAMS_ENDPOINTS = [
+    'https://graph.microsoft.com/v1.0/teams?$select=id,displayName,description',
+    'https://graph.microsoft.com/v1.0/groups?$filter=resourceProvisioningOptions/Any(x:x eq \'Team\')'
+    '&$select=id,displayName,description&$top=999',
+    'https://graph.microsoft.com/v1.0/groups?$select=id,displayName,description&$top=999'
+]
+
+# Drive item fields requested when listing a folder
+CHILD_ITEM_FIELDS = 'id,name,folder,file,size,webUrl'
+
+# Tenant ID -> the teams endpoint that answered for it
+_TEAMS_ENDPOINT_CACHE = {}
+
+# Characters not allowed in SharePoint: " * : < > ? / \ | # % { } ~
+SANITIZE_TABLE = str.maketrans({c: '_' for c in '"*:<>?/\\|#%{}~'})
+
+# Generated filename layouts, used to pick the upload folder
+WMC_FILENAME_PATTERN = re.compile(r'^\d+ WMC-.*\.pdf$')
+NOMINEE_FILENAME_PATTERN = re.compile(r'^[A-Z]{3} \d+ .*\.pdf$')
+
+# Upload session chunk size; Graph requires a multiple of 320 KiB for every chunk but the last
+UPLOAD_CHUNK_SIZE = 10 * 320 * 1024  # 3.125 MiB
+
+# Team ID -> (site_id, site_url, drive_id, expiry timestamp); these do not change between uploads
+_SITE_CACHE = {}
+SITE_CACHE_TTL = 3600  # seconds
+
+def _retry_delay(retry_after, attempt):
+    """Seconds to wait before retrying a throttled request.
+    
+    Graph says how long to back off in Retry-After; fall back to exponential backoff when it doesn't.
+    """
+    try:
+        retry_after = float(retry_after or 0)
+    except ValueError:
+        retry_after = 0
+    return min(max(retry_after, GRAPH_BACKOFF_BASE * 2 ** attempt), GRAPH_MAX_BACKOFF)
+
+def _graph_call(method, url, token_holder=None, **kwargs):
+    """Send a request on the shared session, waiting out 429/503 throttling responses.
+    
+    With a token_holder, the Authorization header is filled from it (refreshing the token
+    when it is about to expire) and a 401 forces one refresh before the request is retried.
+    """
+    attempt = 0
+    refreshed = False
+    while True:
+        if token_holder is not None:
+            token = token_holder.get()
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {token}'}
+        response = _SESSION.request(method, url, **kwargs)
+        
+        if response.status_code == 401 and token_holder is not None and not refreshed:
+            token_holder.refresh(token)
+            refreshed = True
+            continue
+        
+        if response.status_code not in (429, 503) or attempt == GRAPH_MAX_RETRIES:
+            return response
+        
+        time.sleep(_retry_delay(response.headers.get('Retry-After'), attempt))
+        attempt += 1
+
+def _json(response):
+    """Parse a Graph response body with orjson"""
+    return orjson.loads(response.content)
+
+def _error_message(context, response):
+    """Describe a failed Graph response for the caller's error message"""
+    return f"{context}: {response.status_code} - {response.text}"
 
 def sanitize_filename(filename):
     """Remove or replace invalid characters for SharePoint/Teams filenames"""
-    # Characters not allowed in SharePoint: " * : < > ? / \ | # % { } ~
-    invalid_chars = r'[\"*:<>?/\\|#%{}~]'
     # Replace invalid characters with underscores
-    sanitized = re.sub(invalid_chars, '_', filename)
+    sanitized = filename.translate(SANITIZE_TABLE)
     # Remove leading and trailing spaces
     sanitized = sanitized.strip()
     # Remove leading dots (SharePoint doesn't allow filenames starting with dots)
-    sanitized = re.sub(r'^\.+', '', sanitized)
+    sanitized = sanitized.lstrip('.')
     # Limit filename length to 240 characters (to be safe)
     if len(sanitized) > 240:
         name_part, ext_part = os.path.splitext(sanitized)
@@ -28,9 +122,7 @@ def sanitize_filename(filename):
 
 def get_random_suffix():
     """Generate a random string to make filenames unique"""
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=4))
-    return f"{timestamp}_{random_str}"
+    return f"{time.strftime('%Y%m%d%H%M%S')}_{os.urandom(3).hex()}"
 
 def ensure_valid_token(client_id, client_secret, tenant_id, current_token=None, token_expires_at=0):
     """Ensure we have a valid token before making API calls"""
@@ -61,6 +153,45 @@ def ensure_valid_token(client_id, client_secret, tenant_id, current_token=None,
     
     return current_token, token_expires_at, None, None
 
+class TokenHolder:
+    """Graph access token shared by concurrent uploads, renewed shortly before it expires"""
+    
+    def __init__(self, client_id, client_secret, tenant_id, token=None, expires_at=0):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tenant_id = tenant_id
+        self.token = token
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+    
+    def get(self):
+        """Current token, renewed first if it expires within five minutes"""
+        with self.lock:
+            token, expires_at, _, error = ensure_valid_token(
+                self.client_id, self.client_secret, self.tenant_id, self.token, self.expires_at)
+            if not error:
+                self.token, self.expires_at = token, expires_at
+            return self.token
+    
+    def refresh(self, rejected_token):
+        """Force a new token after Graph rejected rejected_token, unless another thread already did"""
+        with self.lock:
+            if self.token == rejected_token:
+                token, expires_at, _, error = ensure_valid_token(
+                    self.client_id, self.client_secret, self.tenant_id)
+                if not error:
+                    self.token, self.expires_at = token, expires_at
+            return self.token
+
+def _token_tenant(access_token):
+    """Tenant ID (tid claim) of a Graph access token, or None if it can't be read"""
+    try:
+        payload = access_token.split('.')[1]
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return claims.get('tid')
+    except Exception:
+        return None
+
 def get_teams(access_token):
     """Get all teams in the organization"""
     try:
@@ -69,19 +200,21 @@ def get_teams(access_token):
             'Content-Type': 'application/json'
         }
         
-        # Try multiple endpoints to get teams data
-        endpoints = [
-            'https://graph.microsoft.com/v1.0/teams',
-            'https://graph.microsoft.com/v1.0/groups?$filter=resourceProvisioningOptions/Any(x:x eq \'Team\')',
-            'https://graph.microsoft.com/v1.0/groups?$select=id,displayName,description'
-        ]
+        # Try multiple endpoints to get teams data, starting with the one that last worked for this tenant
+        endpoints = TEAMS_ENDPOINTS
+        tenant = _token_tenant(access_token)
+        cached_endpoint = _TEAMS_ENDPOINT_CACHE.get(tenant)
+        if cached_endpoint:
+            endpoints = [cached_endpoint] + [endpoint for endpoint in endpoints if endpoint != cached_endpoint]
         
         for endpoint in endpoints:
-            response = requests.get(endpoint, headers=headers)
+            response = _graph_call('GET', endpoint, headers=headers)
             
             if response.status_code == 200:
-                data = response.json()
+                data = _json(response)
                 if 'value' in data and len(data['value']) > 0:
+                    if tenant:
+                        _TEAMS_ENDPOINT_CACHE[tenant] = endpoint
                     return data['value'], None
         
         # If we're here, all methods failed
@@ -89,6 +222,10 @@ def get_teams(access_token):
     except Exception as e:
         return None, f"Failed to get teams: {str(e)}"
 
+def _name_sort_key(item):
+    """Case-insensitive sort key for drive items"""
+    return item['name'].casefold()
+
 def get_team_drive_folders(access_token, team_id, parent_folder_id='root'):
     """Get folders in a team drive"""
     try:
@@ -98,19 +235,19 @@ def get_team_drive_folders(access_token, team_id, parent_folder_id='root'):
         }
         
         # Get the team's SharePoint site
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/groups/{team_id}/sites/root',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/groups/{team_id}/sites/root?$select=id',
             headers=headers
         )
         
         if response.status_code != 200:
             return None, None, f"Error getting team site: {response.status_code}"
         
-        site_id = response.json()['id']
+        site_id = _json(response)['id']
         
         # Get the drives in the site
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives?$select=id',
             headers=headers
         )
         
@@ -118,15 +255,16 @@ def get_team_drive_folders(access_token, team_id, parent_folder_id='root'):
             return None, None, f"Error getting site drives: {response.status_code}"
         
         # Get the documents drive (usually the first one)
-        drives = response.json()['value']
+        drives = _json(response)['value']
         if not drives:
             return None, None, "No drives found in the team site"
         
         drive_id = drives[0]['id']
         
         # Get items in the parent folder
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{parent_folder_id}/children',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{parent_folder_id}/children'
+            f'?$select={CHILD_ITEM_FIELDS}&$top=999',
             headers=headers
         )
         
@@ -134,13 +272,13 @@ def get_team_drive_folders(access_token, team_id, parent_folder_id='root'):
             return drive_id, None, f"Error getting folder items: {response.status_code}"
         
         # Sort items - folders first, then files
-        items = response.json()['value']
+        items = _json(response)['value']
         folders = [item for item in items if 'folder' in item]
         files = [item for item in items if 'folder' not in item]
         
         # Sort alphabetically
-        folders.sort(key=lambda x: x['name'].lower())
-        files.sort(key=lambda x: x['name'].lower())
+        folders.sort(key=_name_sort_key)
+        files.sort(key=_name_sort_key)
         
         all_items = folders + files
         
@@ -152,14 +290,14 @@ def determine_target_folder(filename, finance_team_id, access_token):
     """Determine which folder to upload the file to based on filename pattern and return full folder path"""
     # Pattern matching for Type 1: "000495 WMC-AAM.pdf"
     # Files from WEALTH MANAGEMENT CUBE LIMITED
-    if re.match(r'^\d+ WMC-.*\.pdf$', filename):
+    if WMC_FILENAME_PATTERN.match(filename):
         folder_id = "01OU6MNL3KE3XP2T5JMZC244U33CGKOAMH"  # WMC E-cheque folder ID
         folder_path = "Finance Staff/Bank/Cashflow/WMC E-cheque"
         return folder_id, folder_path, "WMC E-cheque"
     
     # Pattern matching for Type 2: "HKD 100671 Cheung Wilma Veronica.pdf"
     # Files from WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT
-    elif re.match(r'^[A-Z]{3} \d+ .*\.pdf$', filename):
+    elif NOMINEE_FILENAME_PATTERN.match(filename):
         folder_id = "01OU6MNL5F3ZCFDTEACRAJDOX2G4NUMX72"  # E cheque WMC Nominee folder ID
         folder_path = "Finance Staff/Bank/E cheque WMC Nominee"
         return folder_id, folder_path, "E cheque WMC Nominee"
@@ -169,62 +307,117 @@ def determine_target_folder(filename, finance_team_id, access_token):
     folder_path = "Finance Staff/Bank/Cashflow/WMC E-cheque"
     return folder_id, folder_path, "WMC E-cheque"
 
-def upload_with_sharepoint_api(access_token, finance_team_id, folder_path, file_data, filename, folder_id=None, client_id=None, client_secret=None, tenant_id=None, progress_callback=None):
-    """Upload file using SharePoint REST API directly with improved handling for existing files"""
-    try:
-        # Step 1: Get site ID
-        if progress_callback:
-            progress_callback("Getting SharePoint site information...")
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Accept': 'application/json;odata.metadata=minimal'
-        }
-        
-        # Get the team's SharePoint site
-        graph_site_url = f'https://graph.microsoft.com/v1.0/groups/{finance_team_id}/sites/root'
-        response = requests.get(graph_site_url, headers=headers)
-        
-        if response.status_code != 200:
-            error_detail = ""
-            try:
-                error_detail = json.dumps(response.json())
-            except:
-                error_detail = response.text
-            return False, f"Error getting SharePoint site: {response.status_code} - {error_detail}"
-        
-        site_info = response.json()
-        site_url = site_info.get('webUrl', '')
-        site_id = site_info.get('id')
-        
-        if not site_url or not site_id:
-            return False, "Error: Could not determine SharePoint site URL or ID"
-        
-        if progress_callback:
-            progress_callback(f"Found SharePoint site: {site_url}")
-        
-        # Get the drive ID for the site
-        drive_response = requests.get(
-            f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives",
-            headers=headers
+def graph_batch(sub_requests, access_token):
+    """Send Graph requests through $batch, GRAPH_BATCH_LIMIT at a time.
+    
+    Args:
+        sub_requests: Dicts with 'id', 'method' and a 'url' relative to /v1.0
+        access_token: Graph access token
+        
+    Returns:
+        (responses keyed by sub-request id, error_message). Each response has 'status' and 'body'.
+    """
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    
+    responses = {}
+    pending = list(sub_requests)
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            response = _graph_call(
+                'POST', 'https://graph.microsoft.com/v1.0/$batch',
+                headers=headers,
+                json={'requests': pending[start:start + GRAPH_BATCH_LIMIT]}
+            )
+            
+            if response.status_code != 200:
+                return None, _error_message("Graph batch request failed", response)
+            
+            for sub_response in _json(response).get('responses', []):
+                responses[sub_response['id']] = sub_response
+        
+        # Graph throttles sub-requests individually inside a successful batch; resend those
+        throttled = [request for request in pending
+                     if responses.get(request['id'], {}).get('status') in (429, 503)]
+        if not throttled or attempt == GRAPH_MAX_RETRIES:
+            break
+        
+        retry_after = max(
+            _retry_delay(responses[request['id']].get('headers', {}).get('Retry-After'), attempt)
+            for request in throttled
         )
-        
-        if drive_response.status_code != 200:
-            error_detail = ""
-            try:
-                error_detail = json.dumps(drive_response.json())
-            except:
-                error_detail = drive_response.text
-            return False, f"Failed to get drives: {drive_response.status_code} - {error_detail}"
-        
-        drives = drive_response.json().get('value', [])
-        if not drives:
-            return False, "No drives found for site"
-        
-        drive_id = drives[0]['id']
-        
-        if progress_callback:
-            progress_callback(f"Found drive ID: {drive_id}")
+        time.sleep(retry_after)
+        pending = throttled
+    
+    return responses, None
+
+def resolve_site_and_drive(access_token, finance_team_id):
+    """Look up the team's SharePoint site and document drive in a single batch round trip.
+    
+    Results are cached per team for SITE_CACHE_TTL seconds.
+    
+    Returns:
+        (site_id, site_url, drive_id, error_message)
+    """
+    cached = _SITE_CACHE.get(finance_team_id)
+    if cached and cached[3] > time.time():
+        return cached[0], cached[1], cached[2], None
+    
+    # Asking for the group's drives rather than the site's keeps the two lookups independent
+    responses, error = graph_batch([
+        {'id': 'site', 'method': 'GET', 'url': f'/groups/{finance_team_id}/sites/root?$select=id,webUrl'},
+        {'id': 'drives', 'method': 'GET', 'url': f'/groups/{finance_team_id}/drives?$select=id'}
+    ], access_token)
+    if error:
+        return None, None, None, error
+    
+    site_response = responses.get('site', {})
+    if site_response.get('status') != 200:
+        return None, None, None, (f"Error getting SharePoint site: {site_response.get('status')} - "
+                                  f"{orjson.dumps(site_response.get('body')).decode()}")
+    
+    site_info = site_response.get('body', {})
+    site_url = site_info.get('webUrl', '')
+    site_id = site_info.get('id')
+    
+    if not site_url or not site_id:
+        return None, None, None, "Error: Could not determine SharePoint site URL or ID"
+    
+    drive_response = responses.get('drives', {})
+    if drive_response.get('status') != 200:
+        return None, None, None, (f"Failed to get drives: {drive_response.get('status')} - "
+                                  f"{orjson.dumps(drive_response.get('body')).decode()}")
+    
+    drives = drive_response.get('body', {}).get('value', [])
+    if not drives:
+        return None, None, None, "No drives found for site"
+    
+    drive_id = drives[0]['id']
+    _SITE_CACHE[finance_team_id] = (site_id, site_url, drive_id, time.time() + SITE_CACHE_TTL)
+    return site_id, site_url, drive_id, None
+
+def upload_with_sharepoint_api(access_token, drive_id, folder_id, file_data, filename, finance_team_id=None,
+                               progress_callback=None, token_holder=None):
+    """Upload file using SharePoint REST API directly, replacing any existing file of the same name
+    
+    When drive_id is None it is looked up from finance_team_id. A token_holder, when given,
+    supplies the access token for the upload requests.
+    """
+    try:
+        if drive_id is None:
+            # Step 1: Get site and drive IDs
+            if progress_callback:
+                progress_callback("Getting SharePoint site information...")
+            
+            _, site_url, drive_id, error = resolve_site_and_drive(access_token, finance_team_id)
+            if error:
+                return False, error
+            
+            if progress_callback:
+                progress_callback(f"Found SharePoint site: {site_url}")
+                progress_callback(f"Found drive ID: {drive_id}")
         
         # Sanitize filename but don't make it unique (allowing overwrites)
         safe_filename = sanitize_filename(filename)
@@ -233,86 +426,40 @@ def upload_with_sharepoint_api(access_token, finance_team_id, folder_path, file_
         
         # Just use the sanitized filename (enabling overwrites)
         file_to_upload = safe_filename
-        
-        # IMPORTANT: Check if file already exists
-        check_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}/children?$filter=name eq '{file_to_upload}'"
-        check_headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        check_response = requests.get(check_url, headers=check_headers)
-        
-        existing_file_id = None
-        if check_response.status_code == 200:
-            items = check_response.json().get('value', [])
-            if items:
-                existing_file_id = items[0]['id']
-                if progress_callback:
-                    progress_callback(f"File already exists with ID: {existing_file_id}, will update content")
+        # Percent-encode once for the URL path; names can contain spaces, quotes and the like
+        quoted_name = urllib.parse.quote(file_to_upload, safe='')
         
         # For small files (less than 4MB), we can do a simple direct upload
         if len(file_data) < 4 * 1024 * 1024:
             if progress_callback:
                 progress_callback("File is small enough for direct upload")
             
-            if existing_file_id:
-                # Update existing file content
-                upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{existing_file_id}/content"
-                upload_headers = {
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/octet-stream'
-                }
-                
-                upload_response = requests.put(upload_url, headers=upload_headers, data=file_data)
-                
-                if upload_response.status_code in [200, 201]:
-                    if progress_callback:
-                        progress_callback("Updated existing file successfully!")
-                    return True, None
-                
-                # Log the error for debugging
-                error_detail = ""
-                try:
-                    error_detail = json.dumps(upload_response.json())
-                except:
-                    error_detail = upload_response.text
-                
-                return False, f"Failed to update content: {upload_response.status_code} - {error_detail}"
-            else:
-                # Create new file with content
-                upload_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{file_to_upload}:/content"
-                upload_headers = {
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/octet-stream'
-                }
-                
-                upload_response = requests.put(upload_url, headers=upload_headers, data=file_data)
-                
-                if upload_response.status_code in [200, 201]:
-                    if progress_callback:
-                        progress_callback("Direct upload successful!")
-                    return True, None
-                
-                # Log the error for debugging
-                error_detail = ""
-                try:
-                    error_detail = json.dumps(upload_response.json())
-                except:
-                    error_detail = upload_response.text
-                
-                return False, f"Failed to upload content: {upload_response.status_code} - {error_detail}"
+            # conflictBehavior=replace overwrites an existing file, so no lookup is needed first
+            upload_url = (f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{quoted_name}:/content"
+                          f"?@microsoft.graph.conflictBehavior=replace")
+            upload_headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/octet-stream'
+            }
+            
+            upload_response = _graph_call('PUT', upload_url, headers=upload_headers, data=file_data,
+                                          token_holder=token_holder)
+            
+            if upload_response.status_code in [200, 201]:
+                if progress_callback:
+                    progress_callback("Direct upload successful!")
+                return True, None
+            
+            # A stale cached drive shows up as 401/404, so resolve it again next time
+            if upload_response.status_code in (401, 404):
+                _SITE_CACHE.pop(finance_team_id, None)
+            return False, _error_message("Failed to upload content", upload_response)
         
         # For larger files, use upload session
         if progress_callback:
             progress_callback("Creating upload session...")
         
-        if existing_file_id:
-            # Create upload session for existing file
-            session_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{existing_file_id}/createUploadSession"
-        else:
-            # Create upload session for new file
-            session_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{file_to_upload}:/createUploadSession"
+        session_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{quoted_name}:/createUploadSession"
         
         session_headers = {
             'Authorization': f'Bearer {access_token}',
@@ -326,200 +473,66 @@ def upload_with_sharepoint_api(access_token, finance_team_id, folder_path, file_
             }
         }
         
-        session_response = requests.post(session_url, headers=session_headers, json=session_payload)
+        session_response = _graph_call('POST', session_url, headers=session_headers, json=session_payload,
+                                       token_holder=token_holder)
         
         if session_response.status_code != 200:
-            error_detail = ""
-            try:
-                error_detail = json.dumps(session_response.json())
-            except:
-                error_detail = session_response.text
-            
-            return False, f"Failed to create upload session: {session_response.status_code} - {error_detail}"
+            if session_response.status_code in (401, 404):
+                _SITE_CACHE.pop(finance_team_id, None)
+            return False, _error_message("Failed to create upload session", session_response)
         
-        upload_url = session_response.json().get('uploadUrl')
+        upload_url = _json(session_response).get('uploadUrl')
         
         if not upload_url:
             return False, "No upload URL returned in session response"
         
         # Upload in chunks
-        chunk_size = 1 * 1024 * 1024  # 1MB chunks
+        chunk_size = UPLOAD_CHUNK_SIZE
         total_size = len(file_data)
         uploaded = 0
         
+        # Chunks must be sent in order, one at a time; they go over the session's kept-alive
+        # connection, and separate files upload in parallel in upload_files_to_teams.
+        # Slicing a memoryview hands each chunk to requests without copying it out of file_data
+        file_view = memoryview(file_data)
         while uploaded < total_size:
-            chunk_data = file_data[uploaded:uploaded + chunk_size]
+            chunk_data = file_view[uploaded:uploaded + chunk_size]
             chunk_length = len(chunk_data)
             
             start = uploaded
             end = uploaded + chunk_length - 1
             
             chunk_headers = {
-                'Content-Length': str(chunk_length),
                 'Content-Range': f'bytes {start}-{end}/{total_size}'
             }
             
-            chunk_response = requests.put(
-                upload_url,
+            chunk_response = _graph_call(
+                'PUT', upload_url,
                 headers=chunk_headers,
                 data=chunk_data
             )
             
             if chunk_response.status_code not in [200, 201, 202]:
-                error_detail = ""
-                try:
-                    error_detail = json.dumps(chunk_response.json())
-                except:
-                    error_detail = chunk_response.text
-                
-                return False, f"Error uploading chunk {start}-{end}: {chunk_response.status_code} - {error_detail}"
+                return False, _error_message(f"Error uploading chunk {start}-{end}", chunk_response)
             
             uploaded += chunk_length
+            last_status = chunk_response.status_code
             if progress_callback:
                 progress_callback(f"Uploaded {uploaded/total_size:.1%} ({uploaded}/{total_size} bytes)")
-            
-            if chunk_response.status_code in [200, 201]:
-                if progress_callback:
-                    progress_callback("Chunked upload successful!")
-                return True, None
+        
+        # Only the response to the final chunk says whether the file was committed
+        if last_status in [200, 201]:
+            if progress_callback:
+                progress_callback("Chunked upload successful!")
+            return True, None
         
         return False, "Upload completed but unexpected response received"
     except Exception as e:
         return False, f"SharePoint upload error: {str(e)}"
 
-def upload_file_legacy(access_token, drive_id, folder_id, file_data, filename, progress_callback=None):
-    """Original upload method - retained for reference but no longer used"""
-    try:
-        # Sanitize the filename to ensure it's compatible with SharePoint
-        safe_filename = sanitize_filename(filename)
-        
-        # If the filename was changed, log this information
-        if safe_filename != filename and progress_callback:
-            progress_callback(f"Filename sanitized: '{filename}' → '{safe_filename}'")
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}'
-        }
-        
-        file_size = len(file_data)
-        
-        # For files smaller than 4MB, we can do a simple upload
-        if file_size < 4 * 1024 * 1024:
-            content_type = 'application/octet-stream'
-            
-            # Upload the file
-            upload_headers = headers.copy()
-            upload_headers['Content-Type'] = content_type
-            
-            upload_url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{safe_filename}:/content'
-            response = requests.put(
-                upload_url,
-                headers=upload_headers,
-                data=file_data
-            )
-            
-            if response.status_code in [200, 201]:
-                return True, None
-            else:
-                error_detail = ""
-                try:
-                    error_detail = response.json()
-                except:
-                    error_detail = response.text
-                return False, f"Error uploading {safe_filename}: {response.status_code} - {error_detail}"
-        else:
-            # For larger files, use upload session
-            # Create an upload session
-            create_session_url = f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}:/{safe_filename}:/createUploadSession'
-            response = requests.post(
-                create_session_url,
-                headers={
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                },
-                json={}
-            )
-            
-            if response.status_code != 200:
-                error_detail = ""
-                try:
-                    error_detail = response.json()
-                except:
-                    error_detail = response.text
-                return False, f"Error creating upload session: {response.status_code} - {error_detail}"
-            
-            upload_url = response.json()['uploadUrl']
-            
-            # Upload the file in chunks
-            chunk_size = 3 * 1024 * 1024  # 3MB chunks
-            total_size = file_size
-            uploaded = 0
-            
-            file_content_bytes = file_data
-            while uploaded < total_size:
-                chunk_data = file_content_bytes[uploaded:uploaded + chunk_size]
-                chunk_length = len(chunk_data)
-                
-                start = uploaded
-                end = uploaded + chunk_length - 1
-                
-                chunk_headers = {
-                    'Content-Length': str(chunk_length),
-                    'Content-Range': f'bytes {start}-{end}/{total_size}'
-                }
-                
-                chunk_response = requests.put(
-                    upload_url,
-                    headers=chunk_headers,
-                    data=chunk_data
-                )
-                
-                if chunk_response.status_code not in [200, 201, 202]:
-                    error_detail = ""
-                    try:
-                        error_detail = chunk_response.json()
-                    except:
-                        error_detail = chunk_response.text
-                    return False, f"Error uploading chunk {start}-{end}: {chunk_response.status_code} - {error_detail}"
-                
-                uploaded += chunk_length
-                if progress_callback:
-                    progress_callback(uploaded / total_size)
-                
-                if chunk_response.status_code in [200, 201]:
-                    return True, None
-            
-            return False, "Upload failed - Unknown error"
-    except Exception as e:
-        return False, f"Upload error: {str(e)}"
-
-def upload_file(access_token, drive_id, folder_id, file_data, filename, finance_team_id=None, folder_path=None, client_id=None, client_secret=None, tenant_id=None, progress_callback=None):
-    """Upload a file to the specified folder - simplified to always use folder ID"""
-    try:
-        # Always use the direct SharePoint API method with folder ID
-        if progress_callback:
-            progress_callback(f"Uploading {filename} to folder ID: {folder_id}")
-        
-        return upload_with_sharepoint_api(
-            access_token,
-            finance_team_id,
-            folder_path,
-            file_data,
-            filename,
-            folder_id=folder_id,
-            client_id=client_id,
-            client_secret=client_secret,
-            tenant_id=tenant_id,
-            progress_callback=progress_callback
-        )
-    except Exception as e:
-        return False, f"Upload error: {str(e)}"
-
 def upload_files_to_teams(files_to_upload, client_id, client_secret, tenant_id, finance_team_id,
                           access_token=None, token_expires_at=0, progress_callback=None):
     """Upload multiple files to the correct folders in Microsoft Teams based on filename pattern"""
-    upload_results = []
-    
     # First ensure the token is valid
     token, expires_at, _, error = ensure_valid_token(
         client_id, client_secret, tenant_id, access_token, token_expires_at)
@@ -527,52 +540,62 @@ def upload_files_to_teams(files_to_upload, client_id, client_secret, tenant_id,
     if error:
         return None, error, token, expires_at
     
-    # Upload each file to the appropriate folder
+    # Long batches can outlast the token, so uploads take it from a holder that renews it
+    token_holder = TokenHolder(client_id, client_secret, tenant_id, token, expires_at)
+    
+    # Resolve the site and drive once for the whole batch rather than per file
+    if progress_callback:
+        progress_callback("Getting SharePoint site information...")
+    
+    _, _, drive_id, error = resolve_site_and_drive(token, finance_team_id)
+    if error:
+        return None, error, token, expires_at
+    
+    # Determine target folder based on original filename pattern
+    targets = [determine_target_folder(file_info['generated_filename'], finance_team_id, token)
+               for file_info in files_to_upload]
+    
+    # Upload the files concurrently; results are slotted back by index to keep the input order
     total_files = len(files_to_upload)
-    for i, file_info in enumerate(files_to_upload):
-        if progress_callback:
-            progress_callback(f"Processing file {i+1}/{total_files}: {file_info['generated_filename']}")
-        
-        # Get original filename
-        original_filename = file_info['generated_filename']
-        
-        # Determine target folder based on original filename pattern
-        target_folder_id, folder_path, folder_name = determine_target_folder(
-            original_filename,
-            finance_team_id,
-            token
-        )
-        
-        if progress_callback:
-            progress_callback(f"Target folder: {folder_name} (ID: {target_folder_id})")
-            progress_callback(f"Folder path: {folder_path}")
-        
-        # Upload file with the folder ID approach
-        success, error = upload_file(
-            token, 
-            None,  # drive_id not needed as we get it in upload function
-            target_folder_id, 
-            file_info['pdf_data'],
-            original_filename,
-            finance_team_id=finance_team_id,
-            folder_path=folder_path,
-            client_id=client_id,
-            client_secret=client_secret,
-            tenant_id=tenant_id,
-            progress_callback=lambda msg: progress_callback(f"File {i+1}/{total_files}: {msg}")
-            if progress_callback else None
-        )
+    upload_results = [None] * total_files
+    
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        # Workers get no progress callback since it may touch UI elements; progress is reported below
+        futures = {
+            executor.submit(
+                upload_with_sharepoint_api,
+                token,
+                drive_id,
+                target_folder_id,
+                file_info['pdf_data'],
+                file_info['generated_filename'],
+                finance_team_id=finance_team_id,
+                token_holder=token_holder
+            ): i
+            for i, (file_info, (target_folder_id, _, _)) in enumerate(zip(files_to_upload, targets))
+        }
         
-        upload_results.append({
-            'filename': original_filename,
-            'original_filename': file_info.get('original_filename', 'Unknown'),
-            'success': success,
-            'error': error,
-            'target_folder': folder_name,
-            'folder_id': target_folder_id
-        })
+        for completed, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            file_info = files_to_upload[i]
+            target_folder_id, folder_path, folder_name = targets[i]
+            success, error = future.result()
+            
+            if progress_callback:
+                status = "Uploaded" if success else "Failed to upload"
+                progress_callback(f"File {completed}/{total_files}: {status} {file_info['generated_filename']} "
+                                  f"to {folder_name} ({folder_path})")
+            
+            upload_results[i] = {
+                'filename': file_info['generated_filename'],
+                'original_filename': file_info.get('original_filename', 'Unknown'),
+                'success': success,
+                'error': error,
+                'target_folder': folder_name,
+                'folder_id': target_folder_id
+            }
     
-    return upload_results, None, token, expires_at
+    return upload_results, None, token_holder.token, token_holder.expires_at
 
 def authenticate_teams(client_id, client_secret, tenant_id):
     """Authenticate with Microsoft Teams"""
@@ -594,19 +617,19 @@ def get_finance_team_folders(access_token, finance_team_id):
         }
         
         # Get the team's SharePoint site
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/groups/{finance_team_id}/sites/root',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/groups/{finance_team_id}/sites/root?$select=id',
             headers=headers
         )
         
         if response.status_code != 200:
             return None, None, None, f"Error getting Finance Team site: {response.status_code}"
         
-        site_id = response.json()['id']
+        site_id = _json(response)['id']
         
         # Get the drives in the site
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/sites/{site_id}/drives?$select=id',
             headers=headers
         )
         
@@ -614,7 +637,7 @@ def get_finance_team_folders(access_token, finance_team_id):
             return None, None, None, f"Error getting site drives: {response.status_code}"
         
         # Get the documents drive (usually the first one)
-        drives = response.json()['value']
+        drives = _json(response)['value']
         if not drives:
             return None, None, None, "No drives found in the Finance Team site"
         
@@ -636,15 +659,16 @@ def get_folder_contents(access_token, drive_id, folder_id):
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(
-            f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}/children',
+        response = _graph_call(
+            'GET', f'https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{folder_id}/children'
+            f'?$select={CHILD_ITEM_FIELDS}&$top=999',
             headers=headers
         )
         
         if response.status_code != 200:
             return None, f"Error getting folder contents: {response.status_code}"
         
-        items = response.json()['value']
+        items = _json(response)['value']
         return items, None
     except Exception as e:
         return None, f"Failed to get folder contents: {str(e)}"